@@ -3,9 +3,24 @@ import json
 import logging
 import asyncio
 import re
-from typing import Dict, List, Any, Optional
-import openai
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, AsyncIterator, Tuple, Set
+import numpy as np
+import orjson
 from dotenv import load_dotenv
+from knowledge_store import load_knowledge_base, save_knowledge_base, acquire_knowledge_base_lock, create_openai_client, normalize_rows, truncate_for_embedding, embedding_batches, EMBEDDING_DIM
+
+try:
+    import faiss
+except ImportError:  # FAISS is optional; search falls back to a NumPy scan
+    faiss = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional; the NumPy scan uses a table lookup instead
+    njit = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,6 +29,272 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("ai_engine")
 
+# Below this many items an exact flat index is both faster to build and exact
+HNSW_MIN_ITEMS = 1000
+
+# Fraction of an HNSW index's vectors that may be tombstones of edited or removed
+# items before it is rebuilt
+INDEX_MAX_TOMBSTONE_FRACTION = 0.25
+
+# Candidates kept per requested result when prefiltering with binary codes
+BINARY_RESCORE_FACTOR = 4
+
+# Texts sent per embeddings request when backfilling the knowledge base
+EMBEDDING_BATCH_SIZE = 96
+
+# Embedding batch requests allowed in flight at once
+EMBEDDING_MAX_CONCURRENCY = 8
+
+# Maximum number of query/content embeddings kept in memory
+EMBEDDING_CACHE_SIZE = 10_000
+
+# Simple stopwords list (can be expanded)
+STOPWORDS = frozenset({'a', 'an', 'the', 'and', 'or', 'but', 'is', 'are', 'was', 'were',
+                       'be', 'been', 'being', 'in', 'on', 'at', 'to', 'for', 'with', 'by',
+                       'about', 'against', 'between', 'into', 'through', 'during', 'before',
+                       'after', 'above', 'below', 'from', 'up', 'down', 'of', 'off', 'over',
+                       'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when',
+                       'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more',
+                       'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own',
+                       'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just',
+                       'don', 'should', 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain',
+                       'aren', 'couldn', 'didn', 'doesn', 'hadn', 'hasn', 'haven', 'isn',
+                       'ma', 'mightn', 'mustn', 'needn', 'shan', 'shouldn', 'wasn', 'weren',
+                       'won', 'wouldn', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours',
+                       'ourselves', 'you', 'your', 'yours', 'yourself', 'yourselves', 'he',
+                       'him', 'his', 'himself', 'she', 'her', 'hers', 'herself', 'it', 'its',
+                       'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what',
+                       'which', 'who', 'whom', 'this', 'that', 'these', 'those', 'am', 'have',
+                       'has', 'had', 'do', 'does', 'did', 'doing', 'would', 'should', 'could',
+                       'ought', 'get', 'gets', 'got', 'gotten'})
+
+# Word tokenizer used by keyword extraction
+_WORD_RE = re.compile(r'\b\w+\b')
+
+# List item ("- ", "• " or "1. ") in generated knowledge gap suggestions; captures
+# the item text when it is longer than 10 characters and has a word in it, so
+# horizontal rules ("-----") and separator lines are not taken for items
+_BULLET_RE = re.compile(r'^\s*(?:[-•]\s+|\d+\.\s*)(?=.*\w)(\S.{9,}\S)\s*$')
+
+# Semantic response cache: capacity, entry lifetime in seconds and the
+# query similarity above which a cached answer is reused
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 300.0
+RESPONSE_CACHE_THRESHOLD = 0.97
+
+# System prompts are kept byte-identical across requests so the API can reuse its
+# cached prefix; anything per-request (user context, question, knowledge) goes in
+# the user message instead
+SYSTEM_PROMPT = """
+You are AI Sentinel, an advanced AI assistant for IDMS Infotech's ERP system. 
+Your role is to help employees with their questions about using the ERP system.
+You should be professional, helpful, and concise in your responses.
+
+When answering:
+1. Base your answers strictly on the knowledge provided.
+2. If the information isn't in the knowledge base, politely say you don't have that information yet.
+3. Don't make up information not contained in the knowledge snippets.
+4. Recommend escalation to human support for complex issues not adequately covered in the knowledge base.
+5. Include specific steps and navigation paths when explaining processes.
+6. Use language appropriate for enterprise software support.
+
+Format your response as a JSON with the following fields:
+- answer: Your response to the user's question
+- shouldEscalate: true/false whether the query should be escalated to human support
+- relatedQuestions: 2-3 potential follow-up questions related to the user's query
+- category: The category of the question (e.g. "Authentication", "Sales", "HR")
+- confidence: A number between 0 and 1 indicating confidence in your answer
+- sourceKnowledgeIds: Array of IDs of the knowledge items you used in your answer
+"""
+
+KNOWLEDGE_GAPS_PROMPT = """
+You are an expert knowledge base curator for an enterprise ERP system support chatbot.
+Analyze the list of user queries and identify knowledge gaps that should be addressed.
+Focus on topics that are frequently asked but might not be well-covered in a typical knowledge base.
+
+Generate a list of 5-10 specific knowledge article topics that should be created to address these gaps.
+Each suggested topic should be specific enough to create a focused article (not too broad).
+"""
+
+# Number of set bits in every byte value, for Hamming distance on packed codes
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+def _hamming_distances(codes: np.ndarray, q_codes: np.ndarray) -> np.ndarray:
+    """Hamming distance between each row of packed bit codes and a packed query code."""
+    return _POPCOUNT_TABLE[codes ^ q_codes].sum(axis=1)
+
+if njit is not None:
+    # Same scan compiled to a parallel loop, without the (N, bytes) temporary arrays
+    @njit(cache=True, parallel=True)
+    def _hamming_distances(codes, q_codes):
+        distances = np.empty(codes.shape[0], dtype=np.int64)
+        for i in prange(codes.shape[0]):
+            total = 0
+            for j in range(codes.shape[1]):
+                total += _POPCOUNT_TABLE[codes[i, j] ^ q_codes[j]]
+            distances[i] = total
+        return distances
+
+def _normalize(vector) -> np.ndarray:
+    """Return a float32 copy of the vector scaled to unit L2 norm (zero vectors stay zero)."""
+    v = np.asarray(vector, dtype=np.float32).copy()
+    v /= (np.linalg.norm(v) + 1e-12)
+    return v
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry once full.
+    """
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+    
+    def get(self, key: Any) -> Any:
+        """Return the cached value (marking it as recently used) or None if absent."""
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return None
+        return self._data[key]
+    
+    def put(self, key: Any, value: Any):
+        """Insert or refresh a value, evicting the oldest entry if over capacity."""
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class SemanticCache:
+    """
+    Caches query responses by query embedding so that repeated or near-duplicate
+    questions reuse an earlier answer. Entries live in a fixed-size ring buffer,
+    expire after a TTL and only match queries asked with the same user context.
+    """
+    
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._embeddings: Optional[np.ndarray] = None  # (maxsize, D), allocated on first insert
+        self._expires_at = np.zeros(maxsize)  # 0 marks an empty slot
+        self._context_keys = np.zeros(maxsize, dtype=np.int64)
+        self._responses: List[Optional[Dict[str, Any]]] = [None] * maxsize
+        self._next_slot = 0
+    
+    def lookup(self, embedding: np.ndarray, context: str = "", threshold: float = RESPONSE_CACHE_THRESHOLD) -> Optional[Dict[str, Any]]:
+        """
+        Find a live cached response for a similar query.
+        
+        Args:
+            embedding: Unit-norm query embedding
+            context: User context the response was generated for
+            threshold: Minimum cosine similarity to count as a hit
+            
+        Returns:
+            Copy of the cached response, or None on a miss
+        """
+        if self._embeddings is None:
+            return None
+        
+        scores = self._embeddings @ embedding
+        live = (self._expires_at > time.monotonic()) & (self._context_keys == hash(context))
+        scores[~live] = -np.inf
+        
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        return dict(self._responses[best])
+    
+    def insert(self, embedding: np.ndarray, context: str, response: Dict[str, Any]):
+        """Cache a response, overwriting the oldest slot once the cache is full."""
+        if self._embeddings is None:
+            self._embeddings = np.zeros((self.maxsize, len(embedding)), dtype=np.float32)
+        
+        slot = self._next_slot
+        self._embeddings[slot] = embedding
+        self._expires_at[slot] = time.monotonic() + self.ttl
+        self._context_keys[slot] = hash(context)
+        self._responses[slot] = dict(response)
+        self._next_slot = (slot + 1) % self.maxsize
+    
+    def clear(self):
+        """Drop all cached responses."""
+        self._expires_at[:] = 0
+        self._responses = [None] * self.maxsize
+
+class AnswerStreamParser:
+    """
+    Incrementally decodes the "answer" string field of a JSON object whose text
+    arrives in chunks, so the answer can be shown before the object is complete.
+    """
+    
+    _ANSWER_START_RE = re.compile(r'"answer"\s*:\s*"')
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+    
+    def __init__(self):
+        self.buffer = ""
+        self._pos: Optional[int] = None  # Next undecoded index inside the answer string
+        self._done = False
+    
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk of raw JSON text.
+        
+        Args:
+            chunk: Next piece of the streamed JSON
+            
+        Returns:
+            Answer text decoded from this chunk (may be empty)
+        """
+        self.buffer += chunk
+        if self._done:
+            return ""
+        
+        if self._pos is None:
+            match = self._ANSWER_START_RE.search(self.buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+        
+        decoded = []
+        pos = self._pos
+        while pos < len(self.buffer):
+            char = self.buffer[pos]
+            if char == '"':
+                self._done = True
+                break
+            if char != '\\':
+                decoded.append(char)
+                pos += 1
+                continue
+            
+            # Escape sequence; wait for more input if it is cut off
+            if pos + 1 >= len(self.buffer):
+                break
+            escape = self.buffer[pos + 1]
+            if escape == 'u':
+                if pos + 6 > len(self.buffer):
+                    break
+                code = int(self.buffer[pos + 2:pos + 6], 16)
+                if 0xD800 <= code < 0xDC00:
+                    # High surrogate: combine with the following low surrogate escape
+                    if pos + 12 > len(self.buffer):
+                        break
+                    low = int(self.buffer[pos + 8:pos + 12], 16)
+                    code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                    pos += 6
+                decoded.append(chr(code))
+                pos += 6
+            else:
+                decoded.append(self._ESCAPES.get(escape, escape))
+                pos += 2
+        
+        self._pos = pos
+        return "".join(decoded)
+
 class AISentinel:
     """
     Main AI engine for the ERP knowledge chatbot.
@@ -33,17 +314,55 @@ class AISentinel:
         if not self.api_key:
             logger.warning("No OpenAI API key provided. The AI engine will not function properly.")
         
-        # Initialize OpenAI client
-        openai.api_key = self.api_key
+        # Initialize one OpenAI client whose pooled keep-alive connections are reused by every call.
+        # Without a key the client is still created; its requests fail and take the fallback paths.
+        self.client = create_openai_client(self.api_key)
         
-        # Load knowledge base
+        # Load knowledge base, which this process must be the only one serving
         self.knowledge_base_path = knowledge_base_path or "data/knowledge_base.json"
-        self.knowledge_base = self._load_knowledge_base(self.knowledge_base_path)
+        acquire_knowledge_base_lock(self.knowledge_base_path)
+        self.knowledge_base, self._kb_matrix_normed = self._load_knowledge_base(self.knowledge_base_path)
         
         # Embedding cache for efficient similarity search
-        self.embedding_cache = {}
-        
-    def _load_knowledge_base(self, path: Optional[str] = None) -> List[Dict[str, Any]]:
+        self.embedding_cache = LRUCache(maxsize=EMBEDDING_CACHE_SIZE)
+        
+        # ANN index over the unit-norm float16 KB embeddings, built lazily on first search.
+        # Vectors are indexed under labels: an edited item's new vector gets a fresh label,
+        # and its old one is removed from a flat index or, since HNSW can't remove vectors,
+        # left behind as a tombstone that searches skip.
+        self._kb_bits: Optional[np.ndarray] = None
+        self.index = None
+        self._index_is_flat = True
+        self._label_ids: Dict[int, int] = {}  # Label of each live vector -> item ID
+        self._id_labels: Dict[int, int] = {}  # Item ID -> label of its live vector
+        self._next_label = 0
+        
+        # Rebuilds run in a worker thread, one at a time, and record which items were
+        # edited meanwhile (None when no rebuild is running)
+        self._index_lock = asyncio.Lock()
+        self._rebuild_edits: Optional[Set[int]] = None
+        self._rebuild_task: Optional[asyncio.Task] = None
+        
+        # Knowledge item ID of each matrix row and the row of each ID, and whether the
+        # index must be built before searching
+        self._ids: List[int] = [item["id"] for item in self.knowledge_base]
+        self._id_to_row: Dict[int, int] = {item_id: row for row, item_id in enumerate(self._ids)}
+        self._index_stale = True
+        
+        # Items without a stored embedding are embedded on first search
+        self._embeddings_ready = False
+        
+        # Compile the Hamming scan now so JIT time doesn't land on the first query
+        if faiss is None and njit is not None:
+            _hamming_distances(np.zeros((1, EMBEDDING_DIM // 8), dtype=np.uint8), np.zeros(EMBEDDING_DIM // 8, dtype=np.uint8))
+        
+        # Answers to recent queries, matched by embedding similarity
+        self._response_cache = SemanticCache()
+        
+        # Serializes KB embedding backfills triggered by concurrent searches
+        self._embedding_lock = asyncio.Lock()
+        
+    def _load_knowledge_base(self, path: Optional[str] = None) -> Tuple[List[Dict[str, Any]], np.ndarray]:
         """
         Load knowledge base from file or use default sample if none provided.
         
@@ -51,14 +370,14 @@ class AISentinel:
             path: Path to the knowledge base JSON file
             
         Returns:
-            List of knowledge items
+            Tuple of the knowledge items and their unit-norm embedding matrix
+            (all-zero rows for items that have not been embedded yet)
         """
         # Create directory if it doesn't exist
         os.makedirs(os.path.dirname(path or self.knowledge_base_path), exist_ok=True)
         
         try:
-            with open(path or self.knowledge_base_path, 'r') as f:
-                return json.load(f)
+            return load_knowledge_base(path or self.knowledge_base_path)
         except (FileNotFoundError, json.JSONDecodeError):
             logger.warning(f"Knowledge base file not found or invalid. Creating a sample knowledge base.")
             
@@ -69,32 +388,29 @@ class AISentinel:
                     "title": "Resetting ERP Password",
                     "content": "To reset your ERP password, navigate to the login page and click on 'Forgot Password'. Follow the instructions sent to your company email address. Passwords must be at least 8 characters long with a mix of uppercase, lowercase, numbers, and special characters.",
                     "category": "Authentication",
-                    "tags": ["password", "login", "reset", "security"],
-                    "embedding": None
+                    "tags": ["password", "login", "reset", "security"]
                 },
                 {
                     "id": 2,
                     "title": "Generating Sales Reports",
                     "content": "To generate a sales report, go to the Reports module in the Sales dashboard. Select the report type, date range, and any filters you wish to apply. Click 'Generate' and the report will be prepared for viewing or download in your preferred format (PDF, Excel, CSV).",
                     "category": "Sales",
-                    "tags": ["reports", "sales", "export", "analytics"],
-                    "embedding": None
+                    "tags": ["reports", "sales", "export", "analytics"]
                 },
                 {
                     "id": 3,
                     "title": "Submitting Time Off Requests",
                     "content": "To submit a time off request, navigate to the HR module and select 'Time Off'. Click 'New Request', select the type of leave, enter the date range, and provide any necessary details. Submit for approval. Your manager will be notified and will approve or reject your request.",
                     "category": "HR",
-                    "tags": ["time off", "leave", "vacation", "HR", "request"],
-                    "embedding": None
+                    "tags": ["time off", "leave", "vacation", "HR", "request"]
                 }
             ]
             
-            # Save sample knowledge base
-            with open(path or self.knowledge_base_path, 'w') as f:
-                json.dump(sample_kb, f, indent=2)
+            # Save sample knowledge base; embeddings are filled in on first search
+            sample_embeddings = np.zeros((len(sample_kb), EMBEDDING_DIM), dtype=np.float16)
+            save_knowledge_base(path or self.knowledge_base_path, sample_kb, sample_embeddings)
                 
-            return sample_kb
+            return sample_kb, sample_embeddings
             
     async def get_embedding(self, text: str) -> List[float]:
         """
@@ -107,21 +423,23 @@ class AISentinel:
         Returns:
             Embedding vector as a list of floats
         """
-        # Check cache first
-        if text in self.embedding_cache:
-            return self.embedding_cache[text]
+        # Check cache first, keyed on a digest of the whitespace/case-normalized text
+        key = hashlib.blake2b(" ".join(text.lower().split()).encode(), digest_size=16).digest()
+        cached = self.embedding_cache.get(key)
+        if cached is not None:
+            return cached
         
         try:
             # Get embedding from OpenAI
-            response = await openai.embeddings.create(
-                input=text,
+            response = await self.client.embeddings.create(
+                input=truncate_for_embedding(text)[0],
                 model="text-embedding-ada-002"
             )
             
             embedding = response.data[0].embedding
             
             # Cache the result
-            self.embedding_cache[text] = embedding
+            self.embedding_cache.put(key, embedding)
             
             return embedding
         except Exception as e:
@@ -129,6 +447,158 @@ class AISentinel:
             # Return empty embedding in case of error
             return [0.0] * 1536  # Default embedding size for text-embedding-ada-002
     
+    async def _embed_batch(self, texts: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+        """
+        Get embeddings for a batch of texts in a single API request.
+        
+        Args:
+            texts: The texts to embed, already truncated and sized by embedding_batches
+            semaphore: Limits how many batch requests run concurrently
+            
+        Returns:
+            Embedding vectors in the same order as texts
+        """
+        async with semaphore:
+            try:
+                response = await self.client.embeddings.create(
+                    input=texts,
+                    model="text-embedding-ada-002"
+                )
+                return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+            except Exception as e:
+                logger.error(f"Error getting embeddings for knowledge base: {str(e)}")
+                return [[0.0] * 1536] * len(texts)
+    
+    async def _ensure_kb_embeddings(self):
+        """
+        Fetch embeddings for all knowledge items that don't have one yet, sending their
+        contents in concurrent batches rather than one request per item, and save them
+        with the knowledge base so they aren't fetched again on the next start.
+        """
+        async with self._embedding_lock:
+            if self._embeddings_ready:
+                return
+            
+            missing = np.flatnonzero(~self._kb_matrix_normed.any(axis=1)).tolist()
+            
+            # Group texts of similar length so each batch carries a comparable token load,
+            # and keep every batch within the endpoint's input and token limits
+            missing.sort(key=lambda i: len(self.knowledge_base[i]["content"]))
+            chunks = embedding_batches({i: self.knowledge_base[i]["content"] for i in missing}, EMBEDDING_BATCH_SIZE)
+            
+            semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+            results = await asyncio.gather(*(
+                self._embed_batch(list(chunk.values()), semaphore)
+                for chunk in chunks
+            ))
+            
+            if missing:
+                self._make_matrix_writable()
+            for chunk, embeddings in zip(chunks, results):
+                self._kb_matrix_normed[list(chunk)] = normalize_rows(embeddings)
+            
+            if missing:
+                self._index_stale = True
+                # A full save keeps the sidecar aligned with the JSON even when edits were replayed from the change log
+                await asyncio.to_thread(save_knowledge_base, self.knowledge_base_path, self.knowledge_base, self._kb_matrix_normed)
+            
+            self._embeddings_ready = True
+    
+    async def add_items(self, items: List[Dict[str, Any]]):
+        """
+        Add new knowledge items to the search index, or replace existing ones with the same ID,
+        without rebuilding it. Existing items that don't carry an embedding keep their indexed
+        vector; only new items without one are embedded.
+        
+        Args:
+            items: Knowledge items, each with at least "id" and "content"
+        """
+        if not items:
+            return
+        
+        async with self._embedding_lock:
+            items = [dict(item) for item in items]
+            
+            missing = [item for item in items if not item.get("embedding") and item["id"] not in self._id_to_row]
+            if missing:
+                semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+                chunks = embedding_batches({j: item["content"] for j, item in enumerate(missing)}, EMBEDDING_BATCH_SIZE)
+                results = await asyncio.gather(*(self._embed_batch(list(chunk.values()), semaphore) for chunk in chunks))
+                for chunk, embeddings in zip(chunks, results):
+                    for j, embedding in zip(chunk, embeddings):
+                        missing[j]["embedding"] = embedding
+            
+            new_items = []
+            new_rows = []
+            changed_ids = []
+            for item in items:
+                embedding = item.pop("embedding", None)
+                
+                row = self._id_to_row.get(item["id"])
+                if row is None:
+                    self._id_to_row[item["id"]] = len(self._ids) + len(new_items)
+                    new_items.append(item)
+                    new_rows.append(_normalize(embedding).astype(np.float16))
+                    continue
+                
+                self.knowledge_base[row] = item
+                if not embedding:
+                    continue
+                vector = _normalize(embedding).astype(np.float16)
+                if not np.array_equal(self._kb_matrix_normed[row], vector):
+                    self._make_matrix_writable()
+                    self._kb_matrix_normed[row] = vector
+                    if self._kb_bits is not None:
+                        self._kb_bits[row] = np.packbits(vector > 0)
+                    changed_ids.append(item["id"])
+            
+            self.knowledge_base.extend(new_items)
+            self._ids.extend(item["id"] for item in new_items)
+            
+            # Append the new rows to the matrix rather than rebuilding it
+            if new_rows:
+                new_rows = np.asarray(new_rows, dtype=np.float16)
+                self._kb_matrix_normed = np.vstack([self._kb_matrix_normed, new_rows])
+                if self._kb_bits is not None:
+                    self._kb_bits = np.vstack([self._kb_bits, np.packbits(new_rows > 0, axis=1)])
+            
+            self._reindex_items(changed_ids + [item["id"] for item in new_items])
+            self._response_cache.clear()
+    
+    def _make_matrix_writable(self):
+        """
+        Replace a read-only (memory-mapped) KB matrix with a private in-memory copy
+        before rows are modified in place. The file itself is only changed by saving.
+        """
+        if not self._kb_matrix_normed.flags.writeable:
+            self._kb_matrix_normed = np.array(self._kb_matrix_normed)
+    
+    def remove_items(self, item_ids: List[int]):
+        """
+        Remove knowledge items from the search index.
+        
+        Args:
+            item_ids: IDs of the items to remove
+        """
+        removed = {item_id for item_id in item_ids if item_id in self._id_to_row}
+        if not removed:
+            return
+        rows = sorted(self._id_to_row.pop(item_id) for item_id in removed)
+        
+        self.knowledge_base = [item for item in self.knowledge_base if item["id"] in self._id_to_row]
+        self._ids = [item["id"] for item in self.knowledge_base]
+        self._kb_matrix_normed = np.delete(self._kb_matrix_normed, rows, axis=0)
+        if self._kb_bits is not None:
+            self._kb_bits = np.delete(self._kb_bits, rows, axis=0)
+        
+        # Only rows after the first removed one have moved
+        for row in range(rows[0], len(self._ids)):
+            self._id_to_row[self._ids[row]] = row
+        
+        self._reindex_items(removed)
+        
+        self._response_cache.clear()
+    
     async def search_knowledge_base(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """
         Search the knowledge base for relevant items using semantic search.
@@ -142,32 +612,144 @@ class AISentinel:
         """
         # Get embedding for the query
         query_embedding = await self.get_embedding(query)
+        return await self._search_by_embedding(query_embedding, top_k)
+    
+    async def _search_by_embedding(self, query_embedding: List[float], top_k: int = 3) -> List[Dict[str, Any]]:
+        """
+        Search the knowledge base for the items closest to an already computed query embedding.
         
-        # Ensure all knowledge items have embeddings
-        for item in self.knowledge_base:
-            if not item.get("embedding"):
-                item["embedding"] = await self.get_embedding(item["content"])
-        
-        # Calculate similarity scores
-        def cosine_similarity(a, b):
-            dot_product = sum(a_i * b_i for a_i, b_i in zip(a, b))
-            magnitude_a = sum(a_i ** 2 for a_i in a) ** 0.5
-            magnitude_b = sum(b_i ** 2 for b_i in b) ** 0.5
-            if magnitude_a * magnitude_b == 0:
-                return 0
-            return dot_product / (magnitude_a * magnitude_b)
-        
-        # Score all items
-        scored_items = [
-            (item, cosine_similarity(query_embedding, item["embedding"]))
-            for item in self.knowledge_base
-        ]
-        
-        # Sort by score and take top_k
-        scored_items.sort(key=lambda x: x[1], reverse=True)
-        top_items = [item for item, score in scored_items[:top_k]]
+        Args:
+            query_embedding: Embedding vector of the user's query
+            top_k: Number of top results to return
+            
+        Returns:
+            List of most relevant knowledge items
+        """
+        # Embed and index the knowledge base on first use; later edits update it incrementally
+        if not self._embeddings_ready:
+            await self._ensure_kb_embeddings()
+        if self._index_stale:
+            await self._index_matrix()
+        elif self._needs_rebuild() and (self._rebuild_task is None or self._rebuild_task.done()):
+            # The current index stays correct meanwhile, so don't wait for the rebuild
+            self._rebuild_task = asyncio.create_task(self._index_matrix())
+        
+        if not self.knowledge_base:
+            return []
+        
+        q = _normalize(query_embedding)
+        
+        if self.index is not None:
+            # Inner product over unit vectors is cosine similarity. Fetch enough extra
+            # results to make up for tombstones among them.
+            tombstones = self.index.ntotal - len(self._label_ids)
+            _, labels = self.index.search(q[None, :], min(top_k + tombstones, self.index.ntotal))
+            item_ids = [self._label_ids[label] for label in labels[0].tolist() if label in self._label_ids]
+            return [self.knowledge_base[self._id_to_row[item_id]] for item_id in item_ids[:top_k]]
+        
+        # Shortlist candidates by Hamming distance between sign bits, then rescore exactly
+        candidates = np.arange(len(self.knowledge_base))
+        shortlist_size = BINARY_RESCORE_FACTOR * top_k
+        if shortlist_size < len(candidates):
+            q_bits = np.packbits(q > 0)
+            hamming = _hamming_distances(self._kb_bits, q_bits)
+            candidates = np.argpartition(hamming, shortlist_size)[:shortlist_size]
+        
+        # Rows and query are unit-norm, so cosine similarity is a single matrix-vector product
+        # (rows are stored as float16 and upcast only for the candidates being scored)
+        scores = self._kb_matrix_normed[candidates].astype(np.float32) @ q
+        
+        # Select top_k without sorting the full score vector
+        if top_k < len(scores):
+            top_idx = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top_idx = np.arange(len(scores))
+        top_idx = candidates[top_idx[np.argsort(-scores[top_idx], kind="stable")]]
+        
+        return [self.knowledge_base[i] for i in top_idx]
+    
+    async def _index_matrix(self):
+        """
+        Index the KB matrix for inner-product search when FAISS is available
+        (exact for small KBs, HNSW for large ones), building the index in a worker
+        thread so searches and edits carry on meanwhile. Without FAISS, 1-bit sign
+        codes are packed for a cheap Hamming prefilter.
+        """
+        async with self._index_lock:
+            if not self._index_stale and not self._needs_rebuild():
+                return
+            
+            if faiss is None:
+                self._kb_bits = np.packbits(self._kb_matrix_normed > 0, axis=1)
+                self._index_stale = False
+                return
+            
+            ids = list(self._ids)
+            matrix = np.array(self._kb_matrix_normed)
+            self._rebuild_edits = set()
+            try:
+                index = await asyncio.to_thread(self._build_index, matrix)
+            finally:
+                edited, self._rebuild_edits = self._rebuild_edits, None
+            
+            self.index = index
+            self._index_is_flat = len(matrix) < HNSW_MIN_ITEMS
+            self._label_ids = dict(enumerate(ids))
+            self._id_labels = {item_id: label for label, item_id in enumerate(ids)}
+            self._next_label = len(ids)
+            self._index_stale = False
+            
+            # Catch up with the edits made while it was being built
+            self._reindex_items(edited)
+    
+    @staticmethod
+    def _build_index(matrix: np.ndarray):
+        """Build a FAISS index over the rows of a KB matrix, labelled by row number."""
+        dim = matrix.shape[1]
+        if len(matrix) < HNSW_MIN_ITEMS:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        else:
+            index = faiss.IndexIDMap2(faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT))
+        index.add_with_ids(matrix.astype(np.float32), np.arange(len(matrix), dtype=np.int64))
+        return index
+    
+    def _needs_rebuild(self) -> bool:
+        """Whether the index has outgrown a flat index or holds too many tombstones."""
+        if self.index is None:
+            return False
+        if self._index_is_flat:
+            return self.index.ntotal >= HNSW_MIN_ITEMS
+        return self.index.ntotal - len(self._label_ids) > INDEX_MAX_TOMBSTONE_FRACTION * self.index.ntotal
+    
+    def _reindex_items(self, item_ids):
+        """
+        Bring the index entries of edited items in line with the KB matrix: drop the
+        vectors of removed items and replace those of added or changed ones.
         
-        return top_items
+        Args:
+            item_ids: IDs of the edited items
+        """
+        if self._rebuild_edits is not None:
+            self._rebuild_edits.update(item_ids)
+        if self.index is None:
+            return
+        
+        old_labels = [self._id_labels.pop(item_id) for item_id in item_ids if item_id in self._id_labels]
+        for label in old_labels:
+            del self._label_ids[label]
+        if old_labels and self._index_is_flat:
+            self.index.remove_ids(np.asarray(old_labels, dtype=np.int64))
+        
+        live_ids = [item_id for item_id in item_ids if item_id in self._id_to_row]
+        if not live_ids:
+            return
+        labels = np.arange(self._next_label, self._next_label + len(live_ids), dtype=np.int64)
+        self._next_label += len(live_ids)
+        rows = [self._id_to_row[item_id] for item_id in live_ids]
+        self.index.add_with_ids(self._kb_matrix_normed[rows].astype(np.float32), labels)
+        for label, item_id in zip(labels.tolist(), live_ids):
+            self._label_ids[label] = item_id
+            self._id_labels[item_id] = label
     
     def extract_keywords(self, text: str) -> List[str]:
         """
@@ -179,31 +761,8 @@ class AISentinel:
         Returns:
             List of keywords
         """
-        # Simple stopwords list (can be expanded)
-        stopwords = {'a', 'an', 'the', 'and', 'or', 'but', 'is', 'are', 'was', 'were', 
-                    'be', 'been', 'being', 'in', 'on', 'at', 'to', 'for', 'with', 'by',
-                    'about', 'against', 'between', 'into', 'through', 'during', 'before',
-                    'after', 'above', 'below', 'from', 'up', 'down', 'of', 'off', 'over',
-                    'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when',
-                    'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more',
-                    'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own',
-                    'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just',
-                    'don', 'should', 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain',
-                    'aren', 'couldn', 'didn', 'doesn', 'hadn', 'hasn', 'haven', 'isn', 
-                    'ma', 'mightn', 'mustn', 'needn', 'shan', 'shouldn', 'wasn', 'weren',
-                    'won', 'wouldn', 'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 
-                    'ourselves', 'you', 'your', 'yours', 'yourself', 'yourselves', 'he',
-                    'him', 'his', 'himself', 'she', 'her', 'hers', 'herself', 'it', 'its',
-                    'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what',
-                    'which', 'who', 'whom', 'this', 'that', 'these', 'those', 'am', 'have',
-                    'has', 'had', 'do', 'does', 'did', 'doing', 'would', 'should', 'could',
-                    'ought', 'get', 'gets', 'got', 'gotten'}
-        
         # Tokenize and remove stopwords
-        words = re.findall(r'\b\w+\b', text.lower())
-        keywords = [word for word in words if word not in stopwords and len(word) > 1]
-        
-        return keywords
+        return [word for word in _WORD_RE.findall(text.lower()) if len(word) > 1 and word not in STOPWORDS]
     
     async def process_query(self, query: str, user_info: Dict[str, Any] = None) -> Dict[str, Any]:
         """
@@ -216,80 +775,97 @@ class AISentinel:
         Returns:
             Dict containing AI response and metadata
         """
-        # Search knowledge base for relevant items
-        relevant_items = await self.search_knowledge_base(query)
-        
-        # Extract relevant knowledge content
-        knowledge_context = "\n\n".join([
-            f"Title: {item['title']}\nContent: {item['content']}\nCategory: {item['category']}"
-            for item in relevant_items
-        ])
-        
-        # Create chat completion system prompt
-        system_prompt = """
-        You are AI Sentinel, an advanced AI assistant for IDMS Infotech's ERP system. 
-        Your role is to help employees with their questions about using the ERP system.
-        You should be professional, helpful, and concise in your responses.
-        
-        When answering:
-        1. Base your answers strictly on the knowledge provided.
-        2. If the information isn't in the knowledge base, politely say you don't have that information yet.
-        3. Don't make up information not contained in the knowledge snippets.
-        4. Recommend escalation to human support for complex issues not adequately covered in the knowledge base.
-        5. Include specific steps and navigation paths when explaining processes.
-        6. Use language appropriate for enterprise software support.
-        
-        Format your response as a JSON with the following fields:
-        - answer: Your response to the user's question
-        - shouldEscalate: true/false whether the query should be escalated to human support
-        - relatedQuestions: 2-3 potential follow-up questions related to the user's query
-        - category: The category of the question (e.g. "Authentication", "Sales", "HR")
-        - confidence: A number between 0 and 1 indicating confidence in your answer
-        - sourceKnowledgeIds: Array of IDs of the knowledge items you used in your answer
+        response = None
+        async for event in self.process_query_stream(query, user_info):
+            if event["type"] == "response":
+                response = event["response"]
+        return response
+    
+    async def process_query_stream(self, query: str, user_info: Dict[str, Any] = None) -> AsyncIterator[Dict[str, Any]]:
         """
+        Process user query and stream the response as it is generated.
         
+        Args:
+            query: User's question or request
+            user_info: User information for personalization
+            
+        Yields:
+            {"type": "answer", "text": ...} events carrying pieces of the answer as they
+            arrive, followed by one {"type": "response", "response": ...} event with the
+            complete response dict
+        """
         # Add personalization if user info provided
         user_context = ""
         if user_info:
             department = user_info.get('department', '')
             role = user_info.get('role', '')
             if department or role:
-                user_context = f"\nThe user works in the {department} department and has the role of {role}. Tailor your response accordingly."
+                user_context = f"The user works in the {department} department and has the role of {role}. Tailor your response accordingly.\n\n"
+        
+        # Reuse the answer to a near-identical recent query when there is one
+        query_embedding = _normalize(await self.get_embedding(query))
+        cached_response = self._response_cache.lookup(query_embedding, user_context)
+        if cached_response is not None:
+            yield {"type": "answer", "text": cached_response.get("answer", "")}
+            yield {"type": "response", "response": cached_response}
+            return
+        
+        # Search knowledge base for relevant items
+        relevant_items = await self._search_by_embedding(query_embedding)
+        
+        # Extract relevant knowledge content
+        knowledge_context = "\n\n".join([
+            f"Title: {item['title']}\nContent: {item['content']}\nCategory: {item['category']}"
+            for item in relevant_items
+        ])
         
         try:
             # Call OpenAI chat completion API
-            response = await openai.chat.completions.create(
+            stream = await self.client.chat.completions.create(
                 model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
                 messages=[
-                    {"role": "system", "content": system_prompt + user_context},
-                    {"role": "user", "content": f"Question: {query}\n\nRelevant Knowledge:\n{knowledge_context}"}
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": f"{user_context}Question: {query}\n\nRelevant Knowledge:\n{knowledge_context}"}
                 ],
                 temperature=0.7,
-                response_format={"type": "json_object"}
+                response_format={"type": "json_object"},
+                stream=True
             )
             
-            # Extract and parse the JSON response
-            response_content = response.choices[0].message.content
-            json_response = json.loads(response_content)
+            # Forward the answer field as soon as its text arrives
+            parser = AnswerStreamParser()
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                answer_text = parser.feed(chunk.choices[0].delta.content or "")
+                if answer_text:
+                    yield {"type": "answer", "text": answer_text}
+            
+            # Parse the complete JSON response
+            json_response = orjson.loads(parser.buffer)
             
             # Add source knowledge item IDs
             source_ids = [item["id"] for item in relevant_items]
             if "sourceKnowledgeIds" not in json_response:
                 json_response["sourceKnowledgeIds"] = source_ids
             
-            return json_response
+            # Escalations are left uncached so each one gets a fresh look
+            if not json_response.get("shouldEscalate"):
+                self._response_cache.insert(query_embedding, user_context, json_response)
+            
+            yield {"type": "response", "response": json_response}
         
         except Exception as e:
             logger.error(f"Error processing query: {str(e)}")
             # Return fallback response
-            return {
+            yield {"type": "response", "response": {
                 "answer": "I'm sorry, but I encountered an error while processing your question. Please try again or contact support for assistance.",
                 "shouldEscalate": True,
                 "relatedQuestions": [],
                 "category": "Error",
                 "confidence": 0.0,
                 "sourceKnowledgeIds": []
-            }
+            }}
     
     async def generate_knowledge_gaps(self, queries: List[str]) -> List[str]:
         """
@@ -304,21 +880,12 @@ class AISentinel:
         # Combine queries into a single prompt for analysis
         query_list = "\n".join([f"- {query}" for query in queries])
         
-        system_prompt = """
-        You are an expert knowledge base curator for an enterprise ERP system support chatbot.
-        Analyze the list of user queries and identify knowledge gaps that should be addressed.
-        Focus on topics that are frequently asked but might not be well-covered in a typical knowledge base.
-        
-        Generate a list of 5-10 specific knowledge article topics that should be created to address these gaps.
-        Each suggested topic should be specific enough to create a focused article (not too broad).
-        """
-        
         try:
             # Call OpenAI chat completion API
-            response = await openai.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    {"role": "system", "content": KNOWLEDGE_GAPS_PROMPT},
                     {"role": "user", "content": f"Here is a list of recent user queries to our ERP support chatbot:\n\n{query_list}\n\nWhat knowledge base articles should we create to fill gaps in our knowledge base?"}
                 ],
                 temperature=0.8,
@@ -327,18 +894,13 @@ class AISentinel:
             # Extract and parse the response
             response_content = response.choices[0].message.content
             
-            # Extract suggestions line by line, filtering out any lines that aren't actual suggestions
-            lines = response_content.split('\n')
+            # Extract suggestions line by line, keeping only list items long enough to be meaningful
             suggestions = []
             
-            for line in lines:
-                line = line.strip()
-                # Check if line looks like a list item
-                if line.startswith('-') or line.startswith('•') or (len(line) > 2 and line[0].isdigit() and line[1] == '.'):
-                    # Clean up the line
-                    suggestion = line.lstrip('-•0123456789. ').strip()
-                    if suggestion and len(suggestion) > 10:  # Ensure it's a meaningful suggestion
-                        suggestions.append(suggestion)
+            for line in response_content.splitlines():
+                match = _BULLET_RE.match(line)
+                if match:
+                    suggestions.append(match.group(1))
             
             # If no suggestions were parsed, take the whole response
             if not suggestions and response_content.strip():
@@ -3,8 +3,10 @@ import logging
 from typing import Dict, List, Any, Optional
 from fastapi import FastAPI, HTTPException, Depends, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+import orjson
 import uvicorn
 
 # Load environment variables from .env file
@@ -22,7 +24,8 @@ logger = logging.getLogger("api")
 app = FastAPI(
     title="AI Sentinel API",
     description="API for the AI Sentinel of Knowledge Bot for IDMS Infotech's ERP System",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS Configuration
@@ -65,15 +68,26 @@ class KnowledgeItem(BaseModel):
     category: str
     tags: List[str] = []
 
+@app.on_event("startup")
+async def init_singletons():
+    """
+    Create the AI engine and knowledge manager once per process, so the knowledge base
+    is loaded and embedded at startup instead of on every request.
+    
+    They keep the knowledge base in memory and never re-read its files, so only one
+    process may serve it: run a single worker. A second worker fails to start.
+    """
+    app.state.ai = AISentinel(knowledge_base_path=KNOWLEDGE_BASE_PATH)
+    await app.state.ai._ensure_kb_embeddings()
+    app.state.knowledge_manager = KnowledgeManager(knowledge_base_path=KNOWLEDGE_BASE_PATH, ai_engine=app.state.ai)
+
 # Dependency to get AI engine singleton
-async def get_ai_engine():
-    # We could add caching here in the future
-    return AISentinel(knowledge_base_path=KNOWLEDGE_BASE_PATH)
+async def get_ai_engine(request: Request):
+    return request.app.state.ai
 
 # Dependency to get knowledge manager singleton
-async def get_knowledge_manager():
-    # We could add caching here in the future
-    return KnowledgeManager(knowledge_base_path=KNOWLEDGE_BASE_PATH)
+async def get_knowledge_manager(request: Request):
+    return request.app.state.knowledge_manager
 
 @app.get("/")
 async def root():
@@ -101,6 +115,31 @@ async def process_query(request: QueryRequest, ai: AISentinel = Depends(get_ai_e
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
+@app.post("/api/query/stream")
+async def process_query_stream(request: QueryRequest, ai: AISentinel = Depends(get_ai_engine)):
+    """
+    Process a natural language query and stream the answer as Server-Sent Events.
+    
+    Emits "answer" events with pieces of the answer text as they are generated,
+    then a single "response" event with the complete QueryResponse payload.
+    """
+    user_info = {
+        "user_id": request.user_id,
+        "session_id": request.session_id,
+        "department": request.department,
+        "role": request.role
+    }
+    
+    async def event_stream():
+        async for event in ai.process_query_stream(request.query, user_info):
+            if event["type"] == "answer":
+                data = {"text": event["text"]}
+            else:
+                data = event["response"]
+            yield f"event: {event['type']}\ndata: {orjson.dumps(data).decode()}\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/api/knowledge-gaps", response_model=KnowledgeGapsResponse)
 async def generate_knowledge_gaps(request: KnowledgeGapsRequest, ai: AISentinel = Depends(get_ai_engine)):
     """
@@ -180,7 +219,7 @@ async def delete_knowledge_item(item_id: int, km: KnowledgeManager = Depends(get
     Delete a knowledge item
     """
     try:
-        success = km.delete_item(item_id)
+        success = await km.delete_item(item_id)
         if not success:
             raise HTTPException(status_code=404, detail=f"Knowledge item with ID {item_id} not found")
         return {"message": f"Knowledge item with ID {item_id} deleted successfully"}
@@ -222,6 +261,6 @@ if __name__ == "__main__":
     # Get port from environment or use default
     port = int(os.environ.get("API_PORT", 8000))
     
-    # Run the FastAPI app
+    # Run the FastAPI app (in a single worker; see init_singletons)
     logger.info(f"Starting AI Sentinel API on port {port}")
     uvicorn.run("api:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
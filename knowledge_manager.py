@@ -2,9 +2,27 @@ import os
 import json
 import logging
 import asyncio
-from typing import Dict, List, Any, Optional
+import contextlib
+import hashlib
+import random
+import re
+import itertools
+import heapq
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, List, Any, Optional, Set, FrozenSet, Tuple, Union, TYPE_CHECKING
+import numpy as np
 import openai
 from dotenv import load_dotenv
+from knowledge_store import load_knowledge_base, save_knowledge_base, acquire_knowledge_base_lock, create_openai_client, log_upsert, log_delete, normalize_rows, embedding_cache_path, EmbeddingCache, truncate_for_embedding, embedding_batches, EMBEDDING_DIM, EMBEDDING_MODEL
+
+try:
+    import faiss
+except ImportError:  # FAISS is optional; search falls back to a NumPy scan
+    faiss = None
+
+if TYPE_CHECKING:
+    from ai_engine import AISentinel
 
 # Load environment variables from .env file
 load_dotenv()
@@ -13,36 +31,202 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("knowledge_manager")
 
+# Texts sent per embeddings request when embedding many items at once
+EMBEDDING_BATCH_SIZE = 256
+
+# Embedding requests allowed in flight at once
+EMBEDDING_MAX_CONCURRENCY = 16
+
+# Attempts per embedding request on rate limits and transient errors, and the delay before
+# the first retry in seconds
+EMBEDDING_MAX_ATTEMPTS = 5
+EMBEDDING_RETRY_BASE_DELAY = 1.0
+
+# Rows converted at a time when quantizing or scanning the int8 embedding matrix
+EMBEDDING_BLOCK_ROWS = 4096
+
+# Rows sampled to train the FAISS scalar quantizer, and the headroom added to the ranges
+# it learns so that vectors added later rarely fall outside them
+INDEX_TRAIN_SAMPLE = 10_000
+INDEX_RANGE_HEADROOM = 1.25
+
+def _quantize(vectors: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scalar-quantize embeddings to int8 with one scale per row, so each unit-norm row
+    is approximately codes * scale. Per-row scales use the full int8 range even though
+    individual embedding components are small.
+    
+    Args:
+        vectors: 2-D array-like of embeddings
+    
+    Returns:
+        Tuple of the int8 codes and float32 scales
+    """
+    vectors = normalize_rows(vectors)
+    scales = np.abs(vectors).max(axis=1) / 127
+    codes = np.round(vectors / np.maximum(scales, 1e-12)[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+# Common words never suggested as fallback tags
+TAG_STOP_WORDS = frozenset({'the', 'and', 'is', 'in', 'to', 'of', 'for', 'a', 'with', 'on', 'by'})
+
+# Category names in a suggestion response: list items like "1. Category" or "- Category",
+# quoted names, and names after "Category:" (a name never continues onto the next line)
+_LIST_ITEM_RE = re.compile(r'(?:^|\n)[1-3.\-\s]+([A-Za-z &]+)')
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+_CATEGORY_RE = re.compile(r'Category:?\s*([A-Za-z &]+)')
+
+# Least Jaccard similarity of the character shingles of an item's old and new content
+# for an edit to keep the item's embedding, and the length of those shingles
+NEAR_DUPLICATE_MIN_SIMILARITY = 0.95
+NEAR_DUPLICATE_SHINGLE_SIZE = 3
+
+# Shorter content is always re-embedded: in a short text a single changed
+# character ("error 401" / "error 404") can change its meaning
+NEAR_DUPLICATE_MIN_LENGTH = 200
+
+def _shingles(text: str) -> Set[str]:
+    """Character shingles of text, ignoring case and runs of whitespace."""
+    text = " ".join(text.lower().split())
+    return {text[i:i + NEAR_DUPLICATE_SHINGLE_SIZE] for i in range(max(1, len(text) - NEAR_DUPLICATE_SHINGLE_SIZE + 1))}
+
+def _is_near_duplicate(old: str, new: str) -> bool:
+    """
+    Whether an edit of content is small enough (a typo fix, changed whitespace) that
+    the content's embedding still applies. Runs in time linear in the text lengths.
+    
+    Args:
+        old: Content before the edit
+        new: Content after the edit
+        
+    Returns:
+        True if the texts are equal, or both are long and their shingle sets nearly coincide
+    """
+    if old == new:
+        return True
+    if min(len(old), len(new)) < NEAR_DUPLICATE_MIN_LENGTH:
+        return False
+    old_shingles, new_shingles = _shingles(old), _shingles(new)
+    return len(old_shingles & new_shingles) >= NEAR_DUPLICATE_MIN_SIMILARITY * len(old_shingles | new_shingles)
+
+def _distinct_categories(matches) -> List[str]:
+    """First 3 distinct, non-empty category names captured by a sequence of regex matches."""
+    categories = []
+    for match in matches:
+        category = match.group(1).strip()
+        if category and category not in categories:
+            categories.append(category)
+            if len(categories) == 3:
+                break
+    return categories
+
+def _clean_tags(tags: List[str]) -> List[str]:
+    """Lowercase suggested tags and strip punctuation and "tag:" prefixes, dropping ones that are too short."""
+    clean_tags = []
+    for tag in tags:
+        # Remove any unwanted characters
+        tag = tag.strip().lower().strip('"\'.,;:()-')
+        
+        # Skip if too short
+        if len(tag) < 2:
+            continue
+        
+        # Remove any "tag:" prefix
+        if tag.startswith('tag:'):
+            tag = tag[4:].strip()
+        
+        clean_tags.append(tag)
+    return clean_tags
+
 class KnowledgeManager:
     """
     Manages the knowledge base for the AI Sentinel.
     Handles CRUD operations for knowledge items and maintains embeddings.
+    
+    Items returned by its methods are the stored items themselves, not copies,
+    so callers must treat them as read-only.
     """
     
-    def __init__(self, knowledge_base_path: str, api_key: str = None):
+    def __init__(self, knowledge_base_path: str, api_key: str = None, ai_engine: Optional["AISentinel"] = None):
         """
         Initialize the knowledge manager.
         
         Args:
             knowledge_base_path: Path to the knowledge base JSON file
             api_key: OpenAI API key for embeddings
+            ai_engine: AI engine whose search index should follow edits made here,
+                and whose OpenAI client is reused
         """
         # Use provided API key or get from environment variable
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             logger.warning("No OpenAI API key provided. The knowledge manager will not function properly.")
         
-        # Initialize OpenAI client
-        openai.api_key = self.api_key
-        
         # Knowledge base path
         self.knowledge_base_path = knowledge_base_path
         
-        # Load knowledge base
-        self.knowledge_base = self._load_knowledge_base()
+        # AI engine to notify about added, updated and deleted items
+        self.ai_engine = ai_engine
+        
+        # One OpenAI client for every call, so pooled keep-alive connections are reused
+        # instead of opening a new connection (and TLS handshake) per request. Alongside
+        # an AI engine its client is shared, keeping one pool per process.
+        if ai_engine is not None:
+            self.client = ai_engine.client
+        else:
+            self.client = create_openai_client(self.api_key)
+        
+        # Embedding requests are retried by _create_embeddings alone, over the same connection
+        # pool; SDK retries underneath would multiply its attempts and stack two backoffs
+        self._embeddings_client = self.client.with_options(max_retries=0)
+        
+        # Knowledge items, and their unit-norm embeddings as int8-quantized rows of one
+        # matrix with a float32 scale per row (all-zero for items without one); rows are
+        # preallocated with doubling capacity
+        self._emb_matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.int8)
+        self._emb_scales = np.zeros(0, dtype=np.float32)
+        self._emb_id_to_row: Dict[int, int] = {}
+        self._emb_row_ids: List[int] = []
+        
+        # Load knowledge base, indexed by item ID (dicts keep the items in file order). Only
+        # one process may serve it, since IDs are assigned from this in-memory copy.
+        acquire_knowledge_base_lock(self.knowledge_base_path)
+        self._by_id: Dict[int, Dict[str, Any]] = {item["id"]: item for item in self._load_knowledge_base()}
+        
+        # IDs of the items in each lowercased category and under each lowercased tag, and
+        # each item's lowercased category and tag set (lowercased once, when indexed)
+        self._by_category: Dict[str, Set[int]] = {}
+        self._by_tag: Dict[str, Set[int]] = {}
+        self._index_keys: Dict[int, Tuple[str, FrozenSet[str]]] = {}
+        for item in self._by_id.values():
+            self._index_item(item)
+        
+        # Serializes writes to the knowledge base files, which happen off the event loop
+        self._save_lock = asyncio.Lock()
+        
+        # Serializes edits once their embeddings are computed, so that concurrent requests
+        # apply, save and index each edit as a whole (embedding calls still run in parallel)
+        self._edit_lock = asyncio.Lock()
+        
+        # Open batch() blocks, during which saves are deferred, and whether one was deferred
+        self._batch_depth = 0
+        self._dirty = False
+        
+        # 8-bit scalar-quantized inner-product index over the embeddings, keyed by item ID;
+        # built on first search and rebuilt (retraining its quantizer) when the KB doubles
+        self.index = None
+        self._index_built_size = 0
+        
+        # Embeddings of previously seen content, persisted next to the knowledge base
+        self._emb_cache = EmbeddingCache(embedding_cache_path(self.knowledge_base_path))
         
         # Next ID for new items
-        self.next_id = max([item["id"] for item in self.knowledge_base], default=0) + 1
+        self.next_id = max(self._by_id, default=0) + 1
+    
+    @property
+    def knowledge_base(self) -> List[Dict[str, Any]]:
+        """All knowledge items, in file order."""
+        return list(self._by_id.values())
         
     def _load_knowledge_base(self) -> List[Dict[str, Any]]:
         """
@@ -54,20 +238,159 @@ class KnowledgeManager:
         os.makedirs(os.path.dirname(self.knowledge_base_path), exist_ok=True)
         
         try:
-            with open(self.knowledge_base_path, 'r') as f:
-                return json.load(f)
+            items, embeddings = load_knowledge_base(self.knowledge_base_path)
         except (FileNotFoundError, json.JSONDecodeError):
             logger.warning(f"Knowledge base file not found or invalid. Creating empty knowledge base.")
             return []
+        
+        self._emb_matrix = np.empty(embeddings.shape, dtype=np.int8)
+        self._emb_scales = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), EMBEDDING_BLOCK_ROWS):
+            block = slice(start, start + EMBEDDING_BLOCK_ROWS)
+            self._emb_matrix[block], self._emb_scales[block] = _quantize(embeddings[block])
+        
+        self._emb_row_ids = [item["id"] for item in items]
+        self._emb_id_to_row = {item_id: row for row, item_id in enumerate(self._emb_row_ids)}
+        
+        return items
             
-    def _save_knowledge_base(self):
-        """Save the knowledge base to file."""
-        with open(self.knowledge_base_path, 'w') as f:
-            json.dump(self.knowledge_base, f, indent=2)
+    async def _save_knowledge_base(self):
+        """
+        Save the knowledge base to file, with embeddings in the binary sidecar.
+        The current state is captured here and written from a worker thread, so
+        the event loop keeps serving other requests during the write.
+        """
+        if self._defer_save():
+            return
+        
+        async with self._save_lock:
+            items = list(self._by_id.values())
+            rows = [self._emb_id_to_row[item_id] for item_id in self._by_id]
+            matrix = normalize_rows(self._dequantize(rows))
+            await asyncio.to_thread(save_knowledge_base, self.knowledge_base_path, items, matrix)
+    
+    def _defer_save(self) -> bool:
+        """Inside a batch() block, mark the knowledge base as needing a save and return True instead of saving now."""
+        if not self._batch_depth:
+            return False
+        self._dirty = True
+        return True
+    
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        """
+        Defer saving while many items are created, updated or deleted, then save the
+        knowledge base once when the block exits (also if it raises, since the edits
+        made so far are already applied in memory). Blocks may be nested; the
+        outermost one saves.
+        
+        Example:
+            async with knowledge_manager.batch():
+                for article in articles:
+                    await knowledge_manager.create_item(article)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._dirty = False
+                await self._save_knowledge_base()
+    
+    def _dequantize(self, rows: Any) -> np.ndarray:
+        """Float32 embeddings of the given rows (an index, slice or list) of the int8 matrix."""
+        return self._emb_matrix[rows].astype(np.float32) * self._emb_scales[rows][..., None]
+    
+    def _build_index(self):
+        """
+        Build the FAISS index over all stored embeddings, training its 8-bit quantizer's
+        per-dimension ranges on a sample of them.
+        """
+        count = len(self._emb_row_ids)
+        sample = self._dequantize(np.random.default_rng(0).permutation(count)[:INDEX_TRAIN_SAMPLE])
+        
+        quantizer = faiss.IndexScalarQuantizer(EMBEDDING_DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        quantizer.train(np.vstack([sample, -sample]) * INDEX_RANGE_HEADROOM)
+        
+        self.index = faiss.IndexIDMap2(quantizer)
+        for start in range(0, count, EMBEDDING_BLOCK_ROWS):
+            stop = min(start + EMBEDDING_BLOCK_ROWS, count)
+            self.index.add_with_ids(self._dequantize(slice(start, stop)), np.asarray(self._emb_row_ids[start:stop], dtype=np.int64))
+        self._index_built_size = count
+    
+    def _index_item(self, item: Dict[str, Any]):
+        """Add an item to the category and tag indices."""
+        category = item["category"].lower()
+        tags = frozenset(tag.lower() for tag in item.get("tags", []))
+        self._index_keys[item["id"]] = (category, tags)
+        
+        self._by_category.setdefault(category, set()).add(item["id"])
+        for tag in tags:
+            self._by_tag.setdefault(tag, set()).add(item["id"])
+    
+    def _unindex_item(self, item: Dict[str, Any]):
+        """Remove an item from the category and tag indices, under the keys it was indexed with."""
+        category, tags = self._index_keys.pop(item["id"])
+        for index, keys in ((self._by_category, (category,)), (self._by_tag, tags)):
+            for key in keys:
+                ids = index[key]
+                ids.discard(item["id"])
+                if not ids:
+                    del index[key]
+    
+    def _set_embedding(self, item_id: int, embedding: List[float]):
+        """
+        Store the embedding of a knowledge item, adding a row for new items.
+        
+        Args:
+            item_id: ID of the knowledge item
+            embedding: Embedding vector of the item's content
+        """
+        row = self._emb_id_to_row.get(item_id)
+        if row is None:
+            row = len(self._emb_row_ids)
+            if row == len(self._emb_matrix):
+                capacity = max(2 * row, 16)
+                grown = np.zeros((capacity, EMBEDDING_DIM), dtype=np.int8)
+                grown[:row] = self._emb_matrix
+                self._emb_matrix = grown
+                self._emb_scales = np.concatenate([self._emb_scales, np.zeros(capacity - row, dtype=np.float32)])
+            self._emb_id_to_row[item_id] = row
+            self._emb_row_ids.append(item_id)
+        elif self.index is not None:
+            self.index.remove_ids(np.asarray([item_id], dtype=np.int64))
+        
+        codes, scales = _quantize(embedding)
+        self._emb_matrix[row], self._emb_scales[row] = codes[0], scales[0]
+        if self.index is not None:
+            self.index.add_with_ids(self._dequantize(slice(row, row + 1)), np.asarray([item_id], dtype=np.int64))
+    
+    def _remove_embedding(self, item_id: int):
+        """
+        Drop the embedding of a knowledge item, moving the last row into its place.
+        
+        Args:
+            item_id: ID of the knowledge item
+        """
+        if self.index is not None:
+            self.index.remove_ids(np.asarray([item_id], dtype=np.int64))
+        
+        row = self._emb_id_to_row.pop(item_id)
+        last_id = self._emb_row_ids.pop()
+        if last_id != item_id:
+            last = len(self._emb_row_ids)
+            self._emb_matrix[row] = self._emb_matrix[last]
+            self._emb_scales[row] = self._emb_scales[last]
+            self._emb_row_ids[row] = last_id
+            self._emb_id_to_row[last_id] = row
     
     async def get_embedding(self, text: str) -> List[float]:
         """
         Get embedding vector for text using OpenAI's embedding API.
+        Results are cached by content hash, so identical text is only embedded once.
+        Blank text gets an all-zero embedding without calling the API, and text over
+        the model's token limit is embedded by its beginning.
         
         Args:
             text: The text to get embedding for
@@ -75,13 +398,19 @@ class KnowledgeManager:
         Returns:
             Embedding vector as a list of floats
         """
+        if not text.strip():
+            return [0.0] * EMBEDDING_DIM
+        
+        sha = hashlib.sha256(text.encode()).hexdigest()
+        cached = self._emb_cache.get(EMBEDDING_MODEL, sha)
+        if cached is not None:
+            return cached
+        
         try:
-            response = await openai.embeddings.create(
-                input=text,
-                model="text-embedding-ada-002"
-            )
+            response = await self._create_embeddings(truncate_for_embedding(text)[0])
             
             embedding = response.data[0].embedding
+            self._emb_cache.put(EMBEDDING_MODEL, sha, embedding)
             return embedding
         
         except Exception as e:
@@ -89,6 +418,100 @@ class KnowledgeManager:
             # Return empty embedding in case of error
             return [0.0] * 1536  # Default embedding size for text-embedding-ada-002
     
+    async def _log_upsert(self, item: Dict[str, Any]):
+        """Save a created or updated item by appending it to the change log, compacting the log once it outgrows the knowledge base."""
+        if self._defer_save():
+            return
+        
+        async with self._save_lock:
+            embedding = self._dequantize(self._emb_id_to_row[item["id"]])
+            compact = await asyncio.to_thread(log_upsert, self.knowledge_base_path, dict(item), embedding)
+        if compact:
+            await self._save_knowledge_base()
+    
+    async def _log_delete(self, item_id: int):
+        """Save a deleted item by appending it to the change log, compacting the log once it outgrows the knowledge base."""
+        if self._defer_save():
+            return
+        
+        async with self._save_lock:
+            compact = await asyncio.to_thread(log_delete, self.knowledge_base_path, item_id)
+        if compact:
+            await self._save_knowledge_base()
+    
+    async def _create_embeddings(self, texts: Union[str, List[str]]):
+        """
+        Call the embeddings endpoint, retrying with exponential backoff and jitter while
+        rate limited or after a connection or server error.
+        
+        Args:
+            texts: Text or list of texts to embed
+            
+        Returns:
+            The API response
+        """
+        for attempt in range(EMBEDDING_MAX_ATTEMPTS):
+            try:
+                return await self._embeddings_client.embeddings.create(
+                    input=texts,
+                    model=EMBEDDING_MODEL
+                )
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == EMBEDDING_MAX_ATTEMPTS - 1:
+                    raise
+                delay = EMBEDDING_RETRY_BASE_DELAY * 2 ** attempt
+                logger.warning(f"Embeddings request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+    
+    async def _get_embeddings_batch(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+        """
+        Get embedding vectors for many texts, sending the ones that aren't cached
+        in as few API requests as the batch size and request token limit allow.
+        Blank and overlong texts are handled as in get_embedding.
+        
+        Args:
+            texts: The texts to get embeddings for
+            batch_size: Maximum number of texts per request
+            
+        Returns:
+            Embedding vectors in the same order as texts
+        """
+        shas = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        embeddings = [self._emb_cache.get(EMBEDDING_MODEL, sha) for sha in shas]
+        
+        # Each distinct uncached text is embedded once, however often it repeats
+        missing: Dict[str, int] = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None and texts[i].strip():
+                missing.setdefault(shas[i], i)
+        
+        # Split the uncached texts into requests within both limits
+        chunks = embedding_batches({i: texts[i] for i in missing.values()}, batch_size)
+        
+        fetched: Dict[str, List[float]] = {}
+        semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+        
+        async def embed_chunk(chunk: Dict[int, str]):
+            async with semaphore:
+                try:
+                    response = await self._create_embeddings(list(chunk.values()))
+                except Exception as e:
+                    logger.error(f"Error getting embeddings: {str(e)}")
+                    return
+            
+            for i, data in zip(chunk, sorted(response.data, key=lambda d: d.index)):
+                fetched[shas[i]] = data.embedding
+                self._emb_cache.put(EMBEDDING_MODEL, shas[i], data.embedding)
+        
+        # Requests run concurrently instead of leaving the event loop idle on each round trip
+        await asyncio.gather(*(embed_chunk(chunk) for chunk in chunks))
+        
+        # Blank texts and texts whose request failed get an empty embedding, as in get_embedding
+        return [
+            embedding if embedding is not None else fetched.get(sha, [0.0] * EMBEDDING_DIM)
+            for sha, embedding in zip(shas, embeddings)
+        ]
+    
     def get_all_items(self) -> List[Dict[str, Any]]:
         """
         Get all knowledge items.
@@ -96,8 +519,7 @@ class KnowledgeManager:
         Returns:
             List of all knowledge items
         """
-        # Return copies without the embedding vector to reduce response size
-        return [{k: v for k, v in item.items() if k != 'embedding'} for item in self.knowledge_base]
+        return list(self._by_id.values())
     
     def get_item_by_id(self, item_id: int) -> Optional[Dict[str, Any]]:
         """
@@ -109,12 +531,7 @@ class KnowledgeManager:
         Returns:
             Knowledge item dict or None if not found
         """
-        for item in self.knowledge_base:
-            if item["id"] == item_id:
-                # Return copy without embedding vector
-                return {k: v for k, v in item.items() if k != 'embedding'}
-        
-        return None
+        return self._by_id.get(item_id)
     
     def get_items_by_category(self, category: str) -> List[Dict[str, Any]]:
         """
@@ -126,10 +543,8 @@ class KnowledgeManager:
         Returns:
             List of matching knowledge items
         """
-        matching = [item for item in self.knowledge_base if item["category"].lower() == category.lower()]
-        
-        # Return copies without embedding vector
-        return [{k: v for k, v in item.items() if k != 'embedding'} for item in matching]
+        # Sort by ID so results come in creation order
+        return [self._by_id[item_id] for item_id in sorted(self._by_category.get(category.lower(), ()))]
     
     def get_items_by_tags(self, tags: List[str]) -> List[Dict[str, Any]]:
         """
@@ -141,18 +556,50 @@ class KnowledgeManager:
         Returns:
             List of matching knowledge items
         """
-        # Convert tags to lowercase for case-insensitive matching
-        lowercase_tags = [tag.lower() for tag in tags]
+        # Tags are indexed lowercased for case-insensitive matching
+        query = frozenset(tag.lower() for tag in tags)
+        matching = set().union(*(self._by_tag.get(tag, ()) for tag in query))
+        
+        # Sort by ID so results come in creation order
+        return [self._by_id[item_id] for item_id in sorted(matching)]
+    
+    async def search(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Find the knowledge items whose content is semantically closest to a query.
+        
+        Args:
+            query: Text to search for
+            k: Maximum number of items to return
+            
+        Returns:
+            List of matching knowledge items, most similar first
+        """
+        count = len(self._emb_row_ids)
+        if not count or k <= 0:
+            return []
         
-        # Find items with any matching tag
-        matching = []
-        for item in self.knowledge_base:
-            item_tags = [tag.lower() for tag in item.get("tags", [])]
-            if any(tag in item_tags for tag in lowercase_tags):
-                matching.append(item)
+        q = normalize_rows(await self.get_embedding(query))
         
-        # Return copies without embedding vector
-        return [{k: v for k, v in item.items() if k != 'embedding'} for item in matching]
+        if faiss is not None:
+            if self.index is None or count >= 2 * self._index_built_size:
+                self._build_index()
+            
+            # Inner product over unit vectors is cosine similarity
+            _, ids = self.index.search(q, min(k, count))
+            ranked_ids = [int(item_id) for item_id in ids[0] if item_id >= 0]
+        else:
+            # Score the int8 rows a block at a time, applying the row scales afterwards
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, EMBEDDING_BLOCK_ROWS):
+                stop = min(start + EMBEDDING_BLOCK_ROWS, count)
+                scores[start:stop] = self._emb_matrix[start:stop].astype(np.float32) @ q[0]
+            scores *= self._emb_scales[:count]
+            
+            top_rows = np.argpartition(-scores, k)[:k] if k < count else np.arange(count)
+            top_rows = top_rows[np.argsort(-scores[top_rows], kind="stable")]
+            ranked_ids = [self._emb_row_ids[row] for row in top_rows]
+        
+        return [self._by_id[item_id] for item_id in ranked_ids]
     
     async def create_item(self, item_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -164,30 +611,34 @@ class KnowledgeManager:
         Returns:
             Created knowledge item with ID
         """
-        # Create new item with the next available ID
+        # Create new item with the next available ID, reserved before any await so
+        # concurrent creates never share one
         new_item = {
             "id": self.next_id,
             "title": item_data["title"],
             "content": item_data["content"],
             "category": item_data["category"],
-            "tags": item_data.get("tags", []),
-            "embedding": None  # Will be generated below
+            "tags": item_data.get("tags", [])
         }
+        self.next_id += 1
         
         # Generate embedding for the content
-        new_item["embedding"] = await self.get_embedding(new_item["content"])
+        embedding = await self.get_embedding(new_item["content"])
         
-        # Add to knowledge base
-        self.knowledge_base.append(new_item)
-        
-        # Increment next ID
-        self.next_id += 1
-        
-        # Save knowledge base
-        self._save_knowledge_base()
+        async with self._edit_lock:
+            # Add to knowledge base
+            self._by_id[new_item["id"]] = new_item
+            self._index_item(new_item)
+            self._set_embedding(new_item["id"], embedding)
+            
+            # Save knowledge base
+            await self._log_upsert(new_item)
+            
+            # Index the new item for search, reusing its embedding
+            if self.ai_engine:
+                await self.ai_engine.add_items([{**new_item, "embedding": embedding}])
         
-        # Return the new item (without embedding)
-        return {k: v for k, v in new_item.items() if k != 'embedding'}
+        return new_item
     
     async def update_item(self, item_id: int, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
@@ -200,28 +651,49 @@ class KnowledgeManager:
         Returns:
             Updated knowledge item or None if not found
         """
-        # Find the item
-        for i, item in enumerate(self.knowledge_base):
-            if item["id"] == item_id:
-                # Update fields
-                for key, value in updates.items():
-                    if key in ["title", "content", "category", "tags"]:
-                        item[key] = value
-                
-                # If content was updated, regenerate embedding
-                if "content" in updates:
-                    item["embedding"] = await self.get_embedding(item["content"])
-                
-                # Save knowledge base
-                self._save_knowledge_base()
-                
-                # Return updated item (without embedding)
-                return {k: v for k, v in item.items() if k != 'embedding'}
+        if item_id not in self._by_id:
+            return None
+        
+        # If content was updated, regenerate embedding before changing anything, unless
+        # the edit is small enough for the item's current embedding to still apply
+        content = self._by_id[item_id]["content"]
+        embedding = None
+        if "content" in updates and not _is_near_duplicate(content, updates["content"]):
+            embedding = await self.get_embedding(updates["content"])
+        
+        async with self._edit_lock:
+            # Find the item (it may have been deleted while embedding)
+            item = self._by_id.get(item_id)
+            if item is None:
+                return None
+            
+            # Another update may have changed the content the edit was compared with
+            if (embedding is None and "content" in updates and item["content"] != content
+                    and not _is_near_duplicate(item["content"], updates["content"])):
+                embedding = await self.get_embedding(updates["content"])
+            
+            # Update fields
+            self._unindex_item(item)
+            for key, value in updates.items():
+                if key in ["title", "content", "category", "tags"]:
+                    item[key] = value
+            self._index_item(item)
+            
+            if embedding is not None:
+                self._set_embedding(item_id, embedding)
+            
+            # Save knowledge base
+            await self._log_upsert(item)
+            
+            # Refresh the item in the search index, passing the new embedding only when it
+            # was regenerated (the stored one is an int8 approximation, and resending it
+            # would look like a changed vector and force a reindex)
+            if self.ai_engine:
+                await self.ai_engine.add_items([{**item, "embedding": embedding}])
         
-        # Item not found
-        return None
+        return item
     
-    def delete_item(self, item_id: int) -> bool:
+    async def delete_item(self, item_id: int) -> bool:
         """
         Delete a knowledge item.
         
@@ -231,19 +703,22 @@ class KnowledgeManager:
         Returns:
             True if deleted, False if not found
         """
-        # Find the item
-        for i, item in enumerate(self.knowledge_base):
-            if item["id"] == item_id:
-                # Remove from knowledge base
-                self.knowledge_base.pop(i)
-                
-                # Save knowledge base
-                self._save_knowledge_base()
-                
-                return True
+        async with self._edit_lock:
+            # Remove from knowledge base
+            item = self._by_id.pop(item_id, None)
+            if item is None:
+                return False
+            self._unindex_item(item)
+            self._remove_embedding(item_id)
+            
+            # Save knowledge base
+            await self._log_delete(item_id)
+            
+            # Drop the item from the search index
+            if self.ai_engine:
+                self.ai_engine.remove_items([item_id])
         
-        # Item not found
-        return False
+        return True
     
     async def bulk_update_embeddings(self) -> int:
         """
@@ -253,15 +728,21 @@ class KnowledgeManager:
         Returns:
             Number of updated items
         """
-        count = 0
-        
-        for item in self.knowledge_base:
-            # Generate new embedding
-            item["embedding"] = await self.get_embedding(item["content"])
-            count += 1
-        
-        # Save knowledge base
-        self._save_knowledge_base()
+        # Generate new embeddings in batched requests
+        items = list(self._by_id.values())
+        contents = [item["content"] for item in items]
+        embeddings = await self._get_embeddings_batch(contents)
+        
+        async with self._edit_lock:
+            # Skip items deleted or edited meanwhile; an edit stored a fresh embedding itself
+            count = 0
+            for item, content, embedding in zip(items, contents, embeddings):
+                if self._by_id.get(item["id"]) is item and item["content"] == content:
+                    self._set_embedding(item["id"], embedding)
+                    count += 1
+            
+            # Save knowledge base
+            await self._save_knowledge_base()
         
         return count
     
@@ -276,7 +757,7 @@ class KnowledgeManager:
             List of suggested categories
         """
         # Get all existing categories
-        all_categories = list(set(item["category"] for item in self.knowledge_base))
+        all_categories = list(set(item["category"] for item in self._by_id.values()))
         
         # If we have no existing categories, return some common default ones
         if not all_categories:
@@ -298,47 +779,44 @@ class KnowledgeManager:
         
         try:
             # Call OpenAI chat completion API
-            response = await openai.chat.completions.create(
+            stream = await self.client.chat.completions.create(
                 model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
                 messages=[
                     {"role": "system", "content": "You are a knowledge base curator who categorizes ERP documentation."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.3,
-                max_tokens=150
+                max_tokens=150,
+                stream=True
             )
             
-            # Process the response to extract categories
-            response_text = response.choices[0].message.content
-            
-            # Find category names (often they appear in quotes, brackets, or after colons)
-            import re
-            categories = []
-            
-            # Try to find format like "1. Category" or "- Category"
-            list_items = re.findall(r'(?:^|\n)[1-3.\-\s]+([A-Za-z\s&]+)', response_text)
-            if list_items:
-                categories.extend(item.strip() for item in list_items)
-            
-            # Try to find categories in quotes
-            quoted = re.findall(r'"([^"]+)"', response_text)
-            if quoted:
-                categories.extend(item.strip() for item in quoted)
-            
-            # Try to find after "Category:"
-            after_category = re.findall(r'Category:?\s*([A-Za-z\s&]+)', response_text)
-            if after_category:
-                categories.extend(item.strip() for item in after_category)
+            response_text = ""
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                response_text += chunk.choices[0].delta.content
+                if '\n' not in chunk.choices[0].delta.content:
+                    continue
+                
+                # List items come first in the parsing order below, so once three of them
+                # are complete (followed by a character they can't extend over) the rest
+                # of the response can't change the result
+                complete = response_text[:response_text.rfind('\n') + 1]
+                settled = _distinct_categories(m for m in _LIST_ITEM_RE.finditer(complete) if m.end() < len(complete))
+                if len(settled) == 3:
+                    await stream.response.aclose()
+                    return settled
             
-            # Deduplicate and limit to 3
-            unique_categories = []
-            for cat in categories:
-                cat = cat.strip()
-                if cat and cat not in unique_categories:
-                    unique_categories.append(cat)
+            # Find category names (often they appear in list items, quotes, or after colons),
+            # trying each format in turn and stopping at the first 3 distinct ones
+            unique_categories = _distinct_categories(itertools.chain(
+                _LIST_ITEM_RE.finditer(response_text),
+                _QUOTED_RE.finditer(response_text),
+                _CATEGORY_RE.finditer(response_text)
+            ))
             
             if unique_categories:
-                return unique_categories[:3]
+                return unique_categories
             
             # If no categories found, extract from the text directly
             return [line.strip() for line in response_text.split('\n') if line.strip()][:3]
@@ -371,59 +849,53 @@ class KnowledgeManager:
         
         try:
             # Call OpenAI chat completion API
-            response = await openai.chat.completions.create(
+            stream = await self.client.chat.completions.create(
                 model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
                 messages=[
                     {"role": "system", "content": "You are a knowledge base curator who tags ERP documentation."},
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0.3,
-                max_tokens=100
+                max_tokens=100,
+                stream=True
             )
             
-            # Extract tags from response
-            response_text = response.choices[0].message.content
+            response_text = ""
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                response_text += chunk.choices[0].delta.content
+                if ',' not in chunk.choices[0].delta.content:
+                    continue
+                
+                # Once the response contains a comma it is parsed as a comma-separated list,
+                # so every tag before the last comma is final; stop once 5 are in
+                settled = _clean_tags(response_text.split(',')[:-1])
+                if len(settled) >= 5:
+                    await stream.response.aclose()
+                    return settled[:5]
             
             # Try to split by commas first (most common format)
             if ',' in response_text:
-                tags = [tag.strip().lower() for tag in response_text.split(',')]
+                tags = response_text.split(',')
             # If no commas, try to split by newlines
             elif '\n' in response_text:
-                tags = [tag.strip().lower() for tag in response_text.split('\n')]
+                tags = response_text.split('\n')
             # If all else fails, use the whole response as one tag
             else:
-                tags = [response_text.strip().lower()]
-            
-            # Clean up tags
-            clean_tags = []
-            for tag in tags:
-                # Remove any unwanted characters
-                tag = tag.strip().strip('"\'.,;:()-')
-                
-                # Skip if too short
-                if len(tag) < 2:
-                    continue
-                
-                # Remove any "tag:" prefix
-                if tag.startswith('tag:'):
-                    tag = tag[4:].strip()
-                
-                clean_tags.append(tag)
+                tags = [response_text]
             
-            return clean_tags
+            return _clean_tags(tags)
         
         except Exception as e:
             logger.error(f"Error suggesting tags: {str(e)}")
-            # Extract keywords from the text as fallback
+            # Extract keywords from the text as fallback, removing common stop words
             words = text.lower().split()
-            # Remove common stop words
-            stop_words = {'the', 'and', 'is', 'in', 'to', 'of', 'for', 'a', 'with', 'on', 'by'}
-            keywords = [word for word in words if word not in stop_words and len(word) > 3]
+            keywords = [word for word in words if word not in TAG_STOP_WORDS and len(word) > 3]
             
-            # Count and sort by frequency
-            from collections import Counter
+            # Count and take the most frequent without sorting all of them
             counts = Counter(keywords)
-            most_common = [word for word, _ in counts.most_common(5)]
+            most_common = [word for word, _ in heapq.nlargest(5, counts.items(), key=itemgetter(1))]
             
             return most_common
 
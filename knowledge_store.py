@@ -0,0 +1,560 @@
+import os
+import logging
+import base64
+import hashlib
+import sqlite3
+import functools
+from typing import Dict, List, Any, Optional, Tuple, Callable, BinaryIO
+import numpy as np
+import orjson
+import httpx
+import openai
+
+try:
+    import fcntl
+except ImportError:  # fcntl is POSIX-only; elsewhere a second serving process goes undetected
+    fcntl = None
+
+try:
+    import tiktoken
+except ImportError:  # Without tiktoken, token counts are bounded by the UTF-8 length of the text
+    tiktoken = None
+
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("knowledge_store")
+
+# On-disk layout shared by the AI engine and the knowledge manager: item metadata
+# (id, title, content, category, tags) lives in the JSON file, and embeddings live in
+# a binary .npy sidecar next to it as an (N, EMBEDDING_DIM) float16 matrix of unit-norm
+# rows, where row i belongs to item i of the JSON list. Items without an embedding
+# have an all-zero row. The sidecar is memory-mapped read-only on load, so the AI
+# engine and the knowledge manager share one page-cached copy of it, and both files
+# are replaced atomically on save so readers never see a partial write.
+# The two files are replaced one after the other, so the sidecar also ends with a
+# digest of the JSON file it was saved with; a sidecar whose digest doesn't match
+# (read between the two replacements, or left by a crash between them) is ignored.
+#
+# Single-item edits are not written to the snapshot above. They are appended to a
+# change log (one JSON record per line) that is replayed on load, so saving an edit
+# costs one appended line instead of rewriting the whole knowledge base. Saving a
+# full snapshot empties the log, and so does loading a knowledge base that has one.
+#
+# A knowledge base is served by a single process, which holds a lock file next to it.
+
+# Default embedding size for text-embedding-ada-002
+EMBEDDING_DIM = 1536
+
+# Model used for knowledge item embeddings
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Tokens the embedding model accepts per input; longer texts are truncated to it
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+
+# Total input tokens the embeddings endpoint accepts in one request
+EMBEDDING_MAX_REQUEST_TOKENS = 300_000
+
+# Size of the JSON file digest stored after the matrix in the embeddings sidecar
+SNAPSHOT_DIGEST_SIZE = 16
+
+# Buffer size for reading and writing knowledge base files
+IO_BUFFER_SIZE = 1 << 16
+
+# Change logs smaller than this are never compacted, however small the snapshot
+LOG_COMPACT_MIN_BYTES = 1 << 20
+
+# Connection pool limits for the OpenAI HTTP client
+OPENAI_MAX_CONNECTIONS = 100
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 50
+
+# Embeddings kept in memory on top of the persistent embedding cache
+EMBEDDING_CACHE_MEMORY_SIZE = 4096
+
+# Knowledge base lock files held by this process. They stay open for its lifetime:
+# closing any descriptor of a file releases the process's lock on it.
+_held_locks: Dict[str, BinaryIO] = {}
+
+def embeddings_path(knowledge_base_path: str) -> str:
+    """
+    Get the path of the embeddings sidecar for a knowledge base file.
+    
+    Args:
+        knowledge_base_path: Path to the knowledge base JSON file
+    
+    Returns:
+        Path to the .npy file holding its embeddings
+    """
+    return os.path.splitext(knowledge_base_path)[0] + ".embeddings.npy"
+
+def log_path(knowledge_base_path: str) -> str:
+    """
+    Get the path of the change log for a knowledge base file.
+    
+    Args:
+        knowledge_base_path: Path to the knowledge base JSON file
+    
+    Returns:
+        Path to the JSON-lines file of edits made since the last full save
+    """
+    return os.path.splitext(knowledge_base_path)[0] + ".log.jsonl"
+
+def embedding_cache_path(knowledge_base_path: str) -> str:
+    """
+    Get the path of the persistent embedding cache for a knowledge base file.
+    
+    Args:
+        knowledge_base_path: Path to the knowledge base JSON file
+    
+    Returns:
+        Path to the SQLite file caching embeddings by content hash
+    """
+    return os.path.splitext(knowledge_base_path)[0] + ".embcache.sqlite"
+
+def _snapshot_digest(data: bytes) -> bytes:
+    """Digest of the contents of a knowledge base JSON file, tying an embeddings sidecar to it."""
+    return hashlib.blake2b(data, digest_size=SNAPSHOT_DIGEST_SIZE).digest()
+
+def _sidecar_digest(sidecar: str, matrix: np.memmap) -> Optional[bytes]:
+    """JSON file digest stored after the matrix in a sidecar, or None if the sidecar has none."""
+    if os.path.getsize(sidecar) != matrix.offset + matrix.nbytes + SNAPSHOT_DIGEST_SIZE:
+        return None
+    with open(sidecar, 'rb') as f:
+        f.seek(-SNAPSHOT_DIGEST_SIZE, os.SEEK_END)
+        return f.read()
+
+def lock_path(knowledge_base_path: str) -> str:
+    """
+    Get the path of the lock file for a knowledge base file.
+    
+    Args:
+        knowledge_base_path: Path to the knowledge base JSON file
+    
+    Returns:
+        Path to the file locked by the process serving the knowledge base
+    """
+    return os.path.splitext(knowledge_base_path)[0] + ".lock"
+
+def acquire_knowledge_base_lock(path: str):
+    """
+    Claim a knowledge base for this process. A process serving a knowledge base keeps
+    it in memory, assigns item IDs from that copy and saves snapshots of it, so a second
+    process would hand out the same IDs and overwrite the other's edits. Claiming it
+    again from the same process succeeds.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+    
+    Raises:
+        RuntimeError: If another process holds the knowledge base
+    """
+    if fcntl is None:
+        return
+    
+    lock = os.path.realpath(lock_path(path))
+    if lock in _held_locks:
+        return
+    
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    f = open(lock, 'a+b')
+    try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        raise RuntimeError(f"Knowledge base {path} is in use by another process. Serve it from a single worker.")
+    _held_locks[lock] = f
+
+def create_openai_client(api_key: Optional[str]) -> openai.AsyncOpenAI:
+    """
+    Create an OpenAI client over a pool of keep-alive connections, meant to be created
+    once per process and reused by every call.
+    
+    Args:
+        api_key: OpenAI API key; without one the client is still created, and its
+            requests fail
+    
+    Returns:
+        The OpenAI client
+    """
+    return openai.AsyncOpenAI(
+        api_key=api_key or "",
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS
+            )
+        )
+    )
+
+def normalize_rows(matrix: Any) -> np.ndarray:
+    """
+    Scale every row of a matrix to unit L2 norm (all-zero rows stay zero).
+    
+    Args:
+        matrix: 2-D array-like of embeddings
+    
+    Returns:
+        float32 matrix of unit-norm rows
+    """
+    matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    return matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12)
+
+def load_knowledge_base(path: str) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """
+    Load knowledge items and their embeddings.
+    
+    Knowledge bases written before the sidecar existed keep each embedding inline
+    in the JSON; those are moved into the returned matrix. Edits in the change log
+    are applied and saved as a new snapshot, so the embeddings are still served from
+    the shared memory map rather than a private copy with the logged rows applied.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+    
+    Returns:
+        Tuple of the knowledge items (without "embedding") and their float16 embedding
+        matrix, which is a read-only memory map when loaded from the sidecar
+    
+    Raises:
+        FileNotFoundError: If the JSON file does not exist
+        orjson.JSONDecodeError: If the JSON file is invalid (a json.JSONDecodeError subclass)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    items = orjson.loads(data)
+    
+    inline_embeddings = [item.pop("embedding", None) for item in items]
+    
+    matrix = None
+    sidecar = embeddings_path(path)
+    if os.path.exists(sidecar):
+        matrix = np.load(sidecar, mmap_mode="r")
+        if (matrix.shape != (len(items), EMBEDDING_DIM) or matrix.dtype != np.float16
+                or _sidecar_digest(sidecar, matrix) != _snapshot_digest(data)):
+            logger.warning(f"Embeddings file {sidecar} does not match the knowledge base. Ignoring it.")
+            matrix = None
+    
+    if matrix is None:
+        matrix = np.zeros((len(items), EMBEDDING_DIM), dtype=np.float32)
+        for row, embedding in enumerate(inline_embeddings):
+            if embedding:
+                matrix[row] = embedding
+        matrix = normalize_rows(matrix).astype(np.float16)
+    
+    if os.path.exists(log_path(path)):
+        items, matrix = _replay_log(log_path(path), items, matrix)
+        try:
+            save_knowledge_base(path, items, matrix)
+            matrix = np.load(sidecar, mmap_mode="r")
+        except OSError as e:
+            logger.error(f"Error compacting change log: {str(e)}")
+    
+    return items, matrix
+
+def _replay_log(log: str, items: List[Dict[str, Any]], matrix: np.ndarray) -> Tuple[List[Dict[str, Any]], np.ndarray]:
+    """
+    Apply the edits recorded in a change log to a loaded snapshot.
+    
+    Args:
+        log: Path to the change log
+        items: Knowledge items of the snapshot
+        matrix: Embedding matrix of the snapshot
+    
+    Returns:
+        Tuple of the edited knowledge items and their float16 embedding matrix
+    """
+    rows = {item["id"]: row for row, item in enumerate(items)}
+    vectors = list(matrix)
+    
+    # End of the last complete line, and where a record cut short at the end of the log begins
+    offset = 0
+    torn_at = None
+    
+    with open(log, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        for line in f:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # A record cut short by a crash while appending. Records appended after the
+                # crash start on a new line, so only this one is lost.
+                if line.endswith(b"\n"):
+                    logger.warning(f"Ignoring incomplete record in {log}.")
+                    offset += len(line)
+                    continue
+                torn_at = offset
+                break
+            offset += len(line)
+            
+            if record["op"] == "upsert":
+                item = record["item"]
+                vector = np.frombuffer(base64.b64decode(record["embedding"]), dtype=np.float16)
+                row = rows.get(item["id"])
+                if row is None:
+                    rows[item["id"]] = len(items)
+                    items.append(item)
+                    vectors.append(vector)
+                else:
+                    items[row] = item
+                    vectors[row] = vector
+            elif record["op"] == "delete":
+                row = rows.pop(record["id"], None)
+                if row is not None:
+                    items[row] = None
+    
+    if torn_at is not None:
+        logger.warning(f"Removing incomplete record at the end of {log}.")
+        os.truncate(log, torn_at)
+    
+    keep = [row for row, item in enumerate(items) if item is not None]
+    matrix = np.array([vectors[row] for row in keep], dtype=np.float16).reshape(-1, EMBEDDING_DIM)
+    return [items[row] for row in keep], matrix
+
+def _replace_file(path: str, data_writer: Callable[[BinaryIO], None]):
+    """
+    Write a file through a temporary file in the same directory and rename it into place,
+    so the old contents stay intact (and memory maps of them valid) until the new ones are complete.
+    
+    Args:
+        path: Destination path
+        data_writer: Writes the new contents to the open temporary file
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb', buffering=IO_BUFFER_SIZE) as f:
+            data_writer(f)
+            # Flush to disk before the rename, or a crash could leave the new name pointing at an empty file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_embeddings(path: str, matrix: np.ndarray, digest: bytes):
+    """
+    Write the embeddings sidecar for a knowledge base.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+        matrix: Unit-norm embeddings, one row per knowledge item
+        digest: Digest of the JSON file contents the embeddings belong to
+    """
+    matrix = np.asarray(matrix, dtype=np.float16)
+    
+    def write(f: BinaryIO):
+        np.save(f, matrix)
+        f.write(digest)
+    
+    _replace_file(embeddings_path(path), write)
+
+def save_knowledge_base(path: str, items: List[Dict[str, Any]], matrix: np.ndarray):
+    """
+    Write knowledge items and their embeddings.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+        items: Knowledge items without an "embedding" field
+        matrix: Unit-norm embeddings, one row per knowledge item
+    """
+    data = orjson.dumps(items, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+    _replace_file(path, lambda f: f.write(data))
+    
+    save_embeddings(path, matrix, _snapshot_digest(data))
+    
+    # The snapshot now includes every logged edit
+    if os.path.exists(log_path(path)):
+        os.remove(log_path(path))
+
+def _append_to_log(path: str, record: Dict[str, Any]) -> bool:
+    """
+    Append one edit to the change log of a knowledge base.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+        record: Edit to append
+    
+    Returns:
+        True once the log has grown larger than the snapshot it applies to (or there
+        is no snapshot yet), at which point the caller should save a full snapshot
+    """
+    log = log_path(path)
+    with open(log, 'a+b') as f:
+        line = orjson.dumps(record) + b"\n"
+        
+        # Start on a new line if a crash cut the previous record short
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+        f.write(line)
+    
+    # Without a snapshot the log could not be replayed at all
+    if not os.path.exists(path):
+        return True
+    
+    snapshot_size = sum(os.path.getsize(p) for p in (path, embeddings_path(path)) if os.path.exists(p))
+    return os.path.getsize(log) > max(snapshot_size, LOG_COMPACT_MIN_BYTES)
+
+def log_upsert(path: str, item: Dict[str, Any], embedding: Any) -> bool:
+    """
+    Record a created or updated knowledge item in the change log.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+        item: Knowledge item without an "embedding" field
+        embedding: Embedding of the item's content (list or array), or None if it has none
+    
+    Returns:
+        True if the log should now be compacted with save_knowledge_base
+    """
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float16)
+    if embedding is not None and np.any(embedding):
+        vector = normalize_rows(embedding)[0].astype(np.float16)
+    
+    return _append_to_log(path, {
+        "op": "upsert",
+        "item": item,
+        "embedding": base64.b64encode(vector.tobytes()).decode()
+    })
+
+def log_delete(path: str, item_id: int) -> bool:
+    """
+    Record a deleted knowledge item in the change log.
+    
+    Args:
+        path: Path to the knowledge base JSON file
+        item_id: ID of the deleted item
+    
+    Returns:
+        True if the log should now be compacted with save_knowledge_base
+    """
+    return _append_to_log(path, {"op": "delete", "id": item_id})
+
+@functools.lru_cache(maxsize=1)
+def _embedding_encoding():
+    """Tokenizer of the embedding model (loaded once, on first use), or None if it is unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        # Downloads the token ranks on first use unless they are cached
+        return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    except Exception as e:
+        logger.error(f"Error loading tokenizer: {str(e)}")
+        return None
+
+def truncate_for_embedding(text: str) -> Tuple[str, int]:
+    """
+    Cut text down to what the embedding model accepts, so an overlong text is embedded
+    by its beginning instead of being rejected by the API after a round trip.
+    Without the tokenizer, the text is cut to as many UTF-8 bytes as the model accepts
+    tokens, since every token covers at least one byte.
+    
+    Args:
+        text: Text about to be embedded
+        
+    Returns:
+        Tuple of the (possibly truncated) text and its number of tokens
+    """
+    encoding = _embedding_encoding()
+    if encoding is None:
+        data = text.encode()
+        if len(data) > EMBEDDING_MAX_INPUT_TOKENS:
+            # Drop a character cut in half at the end
+            data = data[:EMBEDDING_MAX_INPUT_TOKENS].decode(errors="ignore").encode()
+            text = data.decode()
+        return text, len(data)
+    
+    tokens = encoding.encode(text)
+    if len(tokens) > EMBEDDING_MAX_INPUT_TOKENS:
+        tokens = tokens[:EMBEDDING_MAX_INPUT_TOKENS]
+        text = encoding.decode(tokens)
+    return text, len(tokens)
+
+def embedding_batches(texts: Dict[int, str], batch_size: int) -> List[Dict[int, str]]:
+    """
+    Truncate texts for embedding and split them, in order, into requests that stay
+    within both the batch size and the endpoint's per-request token limit.
+    
+    Args:
+        texts: Texts to embed, keyed by the caller's index for each
+        batch_size: Maximum number of texts per request
+        
+    Returns:
+        One dict of truncated texts per request, keyed like texts
+    """
+    batches = []
+    batch, batch_tokens = {}, 0
+    for key, text in texts.items():
+        text, tokens = truncate_for_embedding(text)
+        if batch and (len(batch) == batch_size or batch_tokens + tokens > EMBEDDING_MAX_REQUEST_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = {}, 0
+        batch[key] = text
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+class EmbeddingCache:
+    """
+    Persistent cache of embedding vectors keyed by embedding model and the SHA-256
+    of the embedded text, so unchanged content is never sent for embedding twice,
+    even across restarts. Recent hits are also kept in memory.
+    """
+    
+    def __init__(self, path: str):
+        """
+        Open (or create) the cache database.
+        
+        Args:
+            path: Path to the SQLite cache file
+        """
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, sha TEXT, dim INT, vec BLOB, PRIMARY KEY (model, sha))"
+            )
+        
+        # Misses raise KeyError, so only hits are memoized
+        self._get = functools.lru_cache(maxsize=EMBEDDING_CACHE_MEMORY_SIZE)(self._select)
+    
+    def _select(self, model: str, sha: str) -> np.ndarray:
+        row = self._conn.execute(
+            "SELECT vec FROM embeddings WHERE model = ? AND sha = ?", (model, sha)
+        ).fetchone()
+        if row is None:
+            raise KeyError(sha)
+        return np.frombuffer(row[0], dtype=np.float32)
+    
+    def get(self, model: str, sha: str) -> Optional[List[float]]:
+        """
+        Look up a cached embedding.
+        
+        Args:
+            model: Embedding model name
+            sha: Hex SHA-256 digest of the embedded text
+        
+        Returns:
+            Embedding vector as a list of floats, or None on a miss
+        """
+        try:
+            return self._get(model, sha).tolist()
+        except KeyError:
+            return None
+    
+    def put(self, model: str, sha: str, embedding: List[float]):
+        """
+        Store an embedding.
+        
+        Args:
+            model: Embedding model name
+            sha: Hex SHA-256 digest of the embedded text
+            embedding: Embedding vector
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (model, sha, dim, vec) VALUES (?, ?, ?, ?)",
+                (model, sha, len(vector), vector.tobytes())
+            )